@@ -2,14 +2,109 @@
 Protein dataset selection and registry for the ML project.
 """
 
-import pandas as pd
-import json
+from concurrent.futures import Future, ProcessPoolExecutor
+import contextlib
+from datetime import datetime, timezone
+import functools
+import multiprocessing
+import os
 from pathlib import Path
+from types import MappingProxyType
+from typing import Optional
 import logging
+import msgspec
 from src.data.sources import get_data_source
 
 logger = logging.getLogger(__name__)
 
+# Column types of the flattened, column-oriented view of the registry
+REGISTRY_COLUMNS = {
+    "protein_id": "string",
+    "meets_criteria": "bool",
+    "resolution": "float32",
+    "aa_count": "Int32",
+    "error": "string",
+    "evaluation_date": "datetime64[ns, UTC]",
+    "ec_numbers": "object",
+}
+
+# Names of the registry attributes that make up its selection criteria
+SELECTION_CRITERIA = ("max_resolution", "min_length", "max_length", "require_ec")
+
+class Evaluation(msgspec.Struct, omit_defaults=True):
+    """Outcome of evaluating one protein against the selection criteria.
+    
+    ``ev[key]``, ``ev.get(key)`` and ``key in ev`` treat unset (None) fields as
+    missing keys; for anything else dict-like use ``to_dict()``.
+    """
+    protein_id: str
+    meets_criteria: bool
+    validation_info: Optional[dict] = None
+    function_info: Optional[dict] = None
+    error: Optional[str] = None
+    evaluation_date: str = ""
+    
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__struct_fields__ else None
+        return default if value is None else value
+    
+    def __contains__(self, key):
+        return key in self.__struct_fields__ and getattr(self, key) is not None
+    
+    def to_dict(self):
+        """Return the record as a plain dict, as stored in the registry file."""
+        return msgspec.to_builtins(self)
+
+_encoder = msgspec.json.Encoder()
+_evaluation_decoder = msgspec.json.Decoder(Evaluation)
+_registry_decoder = msgspec.json.Decoder(dict[str, Evaluation])
+
+def evaluate_protein(data_source, protein_id, max_resolution, min_length, max_length):
+    """Evaluate a single protein against the selection criteria."""
+    try:
+        # Validate structure and get function info from the same header read
+        is_valid, validation_info, function_info = data_source.evaluate_structure(
+            protein_id, max_resolution, min_length, max_length
+        )
+        if function_info is None:
+            # The structure could not be loaded; surface the underlying error
+            function_info = data_source.get_function(protein_id)
+        
+        return Evaluation(
+            protein_id=protein_id,
+            meets_criteria=is_valid,
+            validation_info=validation_info,
+            function_info=function_info,
+            evaluation_date=datetime.now(timezone.utc).isoformat()
+        )
+        
+    except Exception as e:
+        return Evaluation(
+            protein_id=protein_id,
+            meets_criteria=False,
+            error=str(e),
+            evaluation_date=datetime.now(timezone.utc).isoformat()
+        )
+
+# Data source of the current worker process, set up by _init_worker
+_worker_source = None
+
+def _init_worker(data_source):
+    """Install the registry's data source in a worker process of add_proteins."""
+    global _worker_source
+    _worker_source = data_source
+
+def _evaluate_one(protein_id, max_resolution, min_length, max_length):
+    """Evaluate a protein inside a worker process of add_proteins."""
+    return evaluate_protein(
+        _worker_source, protein_id, max_resolution, min_length, max_length
+    )
+
 class ProteinDatasetRegistry:
     """Manages protein selection and dataset creation for the ML project."""
     
@@ -17,85 +112,270 @@ class ProteinDatasetRegistry:
         self.data_source = data_source or get_data_source("pdb")
         self.registry_file = Path(registry_file)
         self.registry_file.parent.mkdir(parents=True, exist_ok=True)
+        
+        # New evaluations go to a JSONL log until compact() folds them in
+        self.log_file = self.registry_file.with_suffix(".jsonl")
         self.proteins = self.load_registry()
+        self._log_fp = None
         
-        # Selection criteria
-        self.selection_criteria = {
-            "max_resolution": 2.5,
-            "min_length": 50,
-            "max_length": 300,
-            "require_ec": True
-        }
+        # Column-oriented view of self.proteins, rebuilt lazily after changes
+        self._df = None
+        
+        # Selection criteria, kept as plain attributes so the per-protein path
+        # reads them without dict lookups
+        self.max_resolution = 2.5
+        self.min_length = 50
+        self.max_length = 300
+        self.require_ec = True
+    
+    @property
+    def selection_criteria(self):
+        """Read-only view of the selection criteria, as reported in the summary.
+        
+        Change criteria through their attributes or by assigning a dict of
+        new values to this property.
+        """
+        return MappingProxyType({
+            name: getattr(self, name) for name in SELECTION_CRITERIA
+        })
+    
+    @selection_criteria.setter
+    def selection_criteria(self, criteria):
+        unknown = set(criteria) - set(SELECTION_CRITERIA)
+        if unknown:
+            raise ValueError(f"Unknown selection criteria: {', '.join(sorted(unknown))}")
+        for name, value in criteria.items():
+            setattr(self, name, value)
     
     def load_registry(self):
-        """Load existing protein registry or create empty one."""
+        """Load existing protein registry or create empty one, replaying the log."""
+        proteins = {}
         if self.registry_file.exists():
-            with open(self.registry_file, 'r') as f:
-                return json.load(f)
-        return {}
+            proteins = _registry_decoder.decode(self.registry_file.read_bytes())
+        self._snapshot_size = len(proteins)
+        self._log_entries = 0
+        
+        if self.log_file.exists():
+            with open(self.log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        evaluation = _evaluation_decoder.decode(line)
+                    except msgspec.DecodeError:
+                        # A torn final line from an interrupted run
+                        logger.warning("Skipping unreadable entry in %s", self.log_file)
+                        continue
+                    proteins[evaluation.protein_id] = evaluation
+                    self._log_entries += 1
+        return proteins
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
-    def save_registry(self):
-        """Save the protein registry to file."""
-        with open(self.registry_file, 'w') as f:
-            json.dump(self.proteins, f, indent=2)
-        logger.info(f"Saved {len(self.proteins)} proteins to registry")
+    def _append_log(self, evaluation):
+        """Record one evaluation at the end of the append-only log."""
+        if self._log_fp is None or self._log_fp.closed:
+            self._log_fp = open(self.log_file, 'ab', buffering=1 << 20)
+        self._log_fp.write(_encoder.encode(evaluation) + b"\n")
+        self._log_entries += 1
+    
+    def _record(self, evaluation):
+        """Store a new evaluation in memory and in the append-only log."""
+        self.proteins[evaluation.protein_id] = evaluation
+        self._append_log(evaluation)
+        self._df = None
+    
+    def save_registry(self, compact=False):
+        """Save the protein registry to file.
+        
+        The snapshot is rewritten once the log outgrows it, or with ``compact=True``.
+        """
+        self._flush_log()
+        if compact or self._log_entries > self._snapshot_size:
+            self.compact()
+        logger.info("Saved %d proteins to registry", len(self.proteins))
+    
+    def compact(self):
+        """Rewrite the registry snapshot and truncate the append-only log."""
+        self._flush_log()
+        tmp_file = self.registry_file.with_suffix(".json.tmp")
+        tmp_file.write_bytes(msgspec.json.format(_encoder.encode(self.proteins), indent=2))
+        tmp_file.replace(self.registry_file)
+        if self._log_fp is not None and not self._log_fp.closed:
+            self._log_fp.truncate(0)
+        elif self.log_file.exists():
+            self.log_file.unlink()
+        self._snapshot_size = len(self.proteins)
+        self._log_entries = 0
+    
+    def _flush_log(self):
+        """Write buffered log entries through to disk."""
+        if self._log_fp is not None and not self._log_fp.closed:
+            self._log_fp.flush()
+    
+    def close(self):
+        """Fold pending evaluations into the snapshot and release the log file."""
+        if self._log_entries:
+            self.compact()
+        if self._log_fp is not None:
+            self._log_fp.close()
+    
+    def to_dataframe(self):
+        """Flatten the registry into a DataFrame with one typed column per field."""
+        # pandas is only needed here, so keep it out of worker start-up
+        import pandas as pd
+        
+        columns = {name: [] for name in REGISTRY_COLUMNS}
+        for protein_id, info in self.proteins.items():
+            validation_info = info.validation_info or {}
+            function_info = info.function_info or {}
+            columns["protein_id"].append(protein_id)
+            columns["meets_criteria"].append(info.meets_criteria)
+            columns["resolution"].append(
+                validation_info.get("resolution", function_info.get("resolution"))
+            )
+            columns["aa_count"].append(validation_info.get("amino_acid_count"))
+            columns["error"].append(info.error)
+            columns["evaluation_date"].append(info.evaluation_date)
+            columns["ec_numbers"].append(function_info.get("ec_numbers") or [])
+        
+        # Entries written before timestamps carried an offset are taken as UTC
+        columns["evaluation_date"] = pd.to_datetime(
+            columns["evaluation_date"], utc=True, format="ISO8601"
+        )
+        return pd.DataFrame(columns).astype(REGISTRY_COLUMNS)
+    
+    def save_parquet(self, path=None):
+        """Write the column-oriented registry view to a Parquet file."""
+        path = Path(path) if path else self.registry_file.with_suffix(".parquet")
+        self.to_dataframe().to_parquet(path, index=False)
+        logger.info("Saved %d proteins to %s", len(self.proteins), path)
+        return path
     
     def add_protein(self, protein_id):
-        """Add a protein to the registry after evaluation."""
+        """Add a protein to the registry after evaluation.
+        
+        A list of IDs may be passed, whose PDB files are then prefetched concurrently.
+        """
+        if not isinstance(protein_id, str):
+            protein_ids = [pid.lower() for pid in protein_id]
+            new_ids = [pid for pid in protein_ids if pid not in self.proteins]
+            if new_ids:
+                self.data_source.prefetch(
+                    new_ids,
+                    depth=len(new_ids),
+                    max_resolution=self.max_resolution,
+                    min_length=self.min_length,
+                )
+            return [self.add_protein(pid) for pid in protein_ids]
+        
         protein_id = protein_id.lower()
         
         if protein_id in self.proteins:
             return self.proteins[protein_id]
         
-        try:
-            # Validate structure
-            is_valid, validation_info = self.data_source.validate_structure(
-                protein_id,
-                max_resolution=self.selection_criteria["max_resolution"],
-                min_length=self.selection_criteria["min_length"],
-                max_length=self.selection_criteria["max_length"]
+        evaluation = evaluate_protein(
+            self.data_source, protein_id, self.max_resolution, self.min_length, self.max_length
+        )
+        self._record(evaluation)
+        return evaluation
+    
+    def add_proteins(self, protein_ids, workers=None, prefetch_depth=16):
+        """Evaluate many proteins in parallel worker processes and save the registry.
+        
+        With ``workers=1`` proteins are evaluated in this process instead.
+        """
+        protein_ids = list(dict.fromkeys(pid.lower() for pid in protein_ids))
+        new_ids = [pid for pid in protein_ids if pid not in self.proteins]
+        
+        if new_ids:
+            workers = min(workers or os.cpu_count() or 1, len(new_ids))
+            criteria = (self.max_resolution, self.min_length, self.max_length)
+            prefetch = functools.partial(
+                self.data_source.prefetch,
+                depth=prefetch_depth,
+                max_resolution=self.max_resolution,
+                min_length=self.min_length,
             )
+            prefetch(new_ids[:prefetch_depth])
             
-            # Get function info
-            function_info = self.data_source.get_function(protein_id)
-            
-            evaluation = {
-                "protein_id": protein_id,
-                "meets_criteria": is_valid,
-                "validation_info": validation_info,
-                "function_info": function_info,
-                "evaluation_date": pd.Timestamp.now().isoformat()
-            }
+            if workers > 1:
+                # Spawned, not forked, as prefetch threads are running here
+                executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.data_source,),
+                )
+                evaluate = functools.partial(executor.submit, _evaluate_one)
+            else:
+                executor = contextlib.nullcontext()
+                evaluate = functools.partial(evaluate_protein, self.data_source)
             
-            self.proteins[protein_id] = evaluation
-            return evaluation
+            with executor:
+                results = []
+                for i, protein_id in enumerate(new_ids):
+                    self.data_source.wait_for_prefetch(protein_id)
+                    if self.data_source.rejected_by_summary(
+                        protein_id, self.max_resolution, self.min_length
+                    ):
+                        # Rejected from the summary cached here; no worker needed
+                        results.append(evaluate_protein(self.data_source, protein_id, *criteria))
+                    else:
+                        results.append(evaluate(protein_id, *criteria))
+                    
+                    # Keep the prefetch window full
+                    if i + prefetch_depth < len(new_ids):
+                        prefetch([new_ids[i + prefetch_depth]])
+                evaluations = [
+                    result.result() if isinstance(result, Future) else result
+                    for result in results
+                ]
             
-        except Exception as e:
-            evaluation = {
-                "protein_id": protein_id,
-                "meets_criteria": False,
-                "error": str(e),
-                "evaluation_date": pd.Timestamp.now().isoformat()
-            }
-            self.proteins[protein_id] = evaluation
-            return evaluation
-    
-    def get_valid_proteins(self):
-        """Get all proteins that meet criteria."""
-        return {pid: info for pid, info in self.proteins.items() 
-                if info.get("meets_criteria", False)}
+            for evaluation in evaluations:
+                self._record(evaluation)
+            self.save_registry()
+        
+        return [self.proteins[pid] for pid in protein_ids]
+    
+    def _frame(self):
+        """Return the cached column-oriented view, rebuilding it if stale."""
+        if self._df is None:
+            self._df = self.to_dataframe()
+        return self._df
+    
+    def get_valid_proteins(self, as_dataframe=False):
+        """Get all proteins that meet criteria.
+        
+        With ``as_dataframe=True`` the matching rows of the column-oriented
+        view are returned instead of the registry entries.
+        """
+        if as_dataframe:
+            df = self._frame()
+            return df[df["meets_criteria"]]
+        return {pid: info for pid, info in self.proteins.items()
+                if info.meets_criteria}
     
     def generate_summary_report(self):
-        """Generate summary report."""
+        """Generate summary report.
+        
+        ``proteins_by_ec_class`` counts the valid proteins annotated with each
+        EC number.
+        """
         total = len(self.proteins)
         valid = len(self.get_valid_proteins())
         
+        df = self._frame()
+        ec_counts = df.loc[df["meets_criteria"], "ec_numbers"].explode().dropna().value_counts()
+        
         return {
             "total_proteins_evaluated": total,
             "valid_proteins": valid,
             "invalid_proteins": total - valid,
-            "proteins_by_ec_class": {},  # Simplified for now
-            "selection_criteria": self.selection_criteria,
+            "proteins_by_ec_class": {ec: int(n) for ec, n in ec_counts.items()},
+            "selection_criteria": dict(self.selection_criteria),
             "registry_file": str(self.registry_file)
         }
 
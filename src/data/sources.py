@@ -3,16 +3,145 @@ Data source abstraction for protein structure and function data.
 """
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import gzip
 import os
+import re
+import shutil
+import tempfile
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from Bio import PDB
 import logging
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bytes moved per read/write when streaming downloads into the cache. Large
+# chunks keep the number of read and write calls per file small.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Seconds to wait for RCSB to connect or send data before giving up
+REQUEST_TIMEOUT = 30
+
+# One CA atom record per standard amino-acid residue; only the first
+# alternate location is matched so disordered residues are counted once.
+# Records are matched from the preceding newline rather than with a
+# multiline "^": the literal prefix lets the regex engine skip straight
+# between candidates instead of attempting a match at every byte.
+_CA_RECORD = re.compile(rb"\nATOM  .{6} CA [ A]")
+
+# Rough in-memory footprint of one parsed atom, including its share of the
+# residue and chain objects (measured with tracemalloc on BioPython 1.8x)
+_BYTES_PER_ATOM = 1200
+
+def _estimate_structure_size(structure):
+    """Estimate how many bytes a parsed structure occupies."""
+    return _BYTES_PER_ATOM * sum(1 for _ in structure.get_atoms())
+
+class _StructureCache:
+    """Thread-safe LRU cache of parsed structures bounded by estimated size."""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, protein_id):
+        return protein_id in self._entries
+    
+    def get(self, protein_id):
+        """Return a cached structure, marking it most recently used."""
+        with self._lock:
+            entry = self._entries.get(protein_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(protein_id)
+            return entry[0]
+    
+    def put(self, protein_id, structure):
+        """Cache a structure, evicting least recently used ones to make room."""
+        size = _estimate_structure_size(structure)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(protein_id, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[protein_id] = (structure, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+    
+    def discard(self, protein_id):
+        """Drop one cached structure, if present."""
+        with self._lock:
+            entry = self._entries.pop(protein_id, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+    
+    def clear(self):
+        """Drop every cached structure."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+def _etag_path(pdb_file):
+    """Sidecar file holding the HTTP ETag of a cached PDB file."""
+    return pdb_file.with_name(pdb_file.name + ".etag")
+
+def _open_pdb(pdb_file, mode='rt'):
+    """Open a cached PDB file, transparently decompressing ``.gz`` files."""
+    if pdb_file.suffix == ".gz":
+        return gzip.open(pdb_file, mode)
+    return open(pdb_file, mode)
+
+def _count_standard_residues(pdb_file):
+    """Count standard amino-acid residues by scanning the raw PDB file.
+    
+    One residue is counted per ``ATOM`` record of a CA atom (first or only
+    alternate location). ATOM residues without a CA atom, such as
+    nucleotides or residues with unmodelled backbones, are not counted; the
+    earlier BioPython count of all non-hetero residues included them.
+    """
+    with _open_pdb(pdb_file, 'rb') as f:
+        buf = f.read()
+    # findall loops in C; no Python-level iteration per residue. A record on
+    # the very first line has no preceding newline and is checked separately.
+    count = len(_CA_RECORD.findall(buf))
+    if _CA_RECORD.match(b"\n" + buf[:20]):
+        count += 1
+    return count
+
+def _header_from_summary(summary):
+    """Map an RCSB entry summary onto the header fields used by get_function."""
+    entry_info = summary.get("rcsb_entry_info") or {}
+    exptl = summary.get("exptl") or [{}]
+    keywords = (summary.get("struct_keywords") or {}).get("text")
+    return {
+        "name": ((summary.get("struct") or {}).get("title") or "").lower(),
+        "resolution": (entry_info.get("resolution_combined") or [None])[0],
+        "structure_method": (exptl[0].get("method") or "").lower(),
+        "keywords": keywords.lower() if keywords else [],
+    }
+
+def _function_from_header(protein_id, header):
+    """Build the functional annotation returned by get_function from a header."""
+    return {
+        "id": protein_id,
+        "description": header.get("name", ""),
+        "resolution": header.get("resolution", None),
+        "structure_method": header.get("structure_method", ""),
+        "keywords": header.get("keywords", []),
+        "ec_numbers": []
+    }
+
 class ProteinDataSource(ABC):
     """Abstract base class for all protein data sources."""
     
@@ -25,73 +154,405 @@ class ProteinDataSource(ABC):
     def get_function(self, protein_id):
         """Retrieve functional annotation for a protein."""
         pass
+    
+    def prefetch(self, protein_ids, depth=16, max_resolution=None, min_length=None):
+        """Start fetching data for proteins in the background, if supported."""
+        pass
+    
+    def wait_for_prefetch(self, protein_id):
+        """Block until a pending prefetch of ``protein_id`` has finished."""
+        pass
+    
+    def rejected_by_summary(self, protein_id, max_resolution=None, min_length=None):
+        """Return why cheap metadata already rules out a protein, or None."""
+        return None
+    
+    def evaluate_structure(self, protein_id, max_resolution, min_length, max_length):
+        """Return ``(is_valid, validation_info, function_info)`` for a protein."""
+        is_valid, validation_info = self.validate_structure(
+            protein_id, max_resolution, min_length, max_length
+        )
+        return is_valid, validation_info, self.get_function(protein_id)
 
 class PDBDataSource(ProteinDataSource):
     """Implementation of ProteinDataSource for the Protein Data Bank."""
     
-    def __init__(self, cache_dir="../data/raw"):
+    def __init__(self, cache_dir="../data/raw", max_workers=32, structure_cache_bytes=2 << 30):
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.pdb_url = "https://files.rcsb.org/download/{}.pdb"
+        self.pdb_url = "https://files.rcsb.org/download/{}.pdb.gz"
+        self.entry_url = "https://data.rcsb.org/rest/v1/core/entry/{}"
         self.parser = PDB.PDBParser(QUIET=True)
-        logger.info(f"PDB data source initialized with cache at {self.cache_dir}")
+        self.max_workers = max_workers
+        
+        # One persistent session so every download reuses pooled keep-alive
+        # connections instead of paying a TCP and TLS handshake per file;
+        # transient gateway errors are retried with backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(64, max_workers),
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        )
+        self.session.mount("https://", adapter)
+        
+        # Background downloads started by prefetch(), keyed on protein ID
+        self._prefetch_executor = None
+        self._prefetching = {}
+        self._prefetch_lock = threading.RLock()
+        
+        # Parsed structures are kept in a per-instance LRU bounded by their
+        # estimated memory use, so repeated reads skip the parse; a size of 0
+        # disables it. BioPython's parser is not thread-safe, hence the lock.
+        self.structure_cache_bytes = structure_cache_bytes
+        self._structure_cache = _StructureCache(structure_cache_bytes)
+        self._parse_lock = threading.Lock()
+        self._parse_executor = None
+        self._load_entry_summary = functools.lru_cache(maxsize=4096)(
+            self._fetch_entry_summary
+        )
+        logger.info("PDB data source initialized with cache at %s", self.cache_dir)
     
-    def get_structure(self, protein_id, parser="biopython"):
-        """Retrieve structure for a protein from PDB."""
-        protein_id = protein_id.lower()
-        pdb_file = self.cache_dir / f"{protein_id}.pdb"
+    def __reduce__(self):
+        # Pickle to the constructor arguments; session and caches are not copied
+        return (
+            self.__class__,
+            (str(self.cache_dir), self.max_workers, self.structure_cache_bytes),
+        )
+    
+    def _pdb_path(self, protein_id):
+        """Path of the cached PDB file for a (lower-cased) protein ID.
         
-        if not pdb_file.exists():
-            url = self.pdb_url.format(protein_id)
-            logger.info(f"Downloading {url}")
-            response = requests.get(url)
+        Files are cached gzip-compressed; older uncompressed files are still used.
+        """
+        legacy_file = self.cache_dir / f"{protein_id}.pdb"
+        if legacy_file.exists():
+            return legacy_file
+        return self.cache_dir / f"{protein_id}.pdb.gz"
+    
+    def _fetch(self, protein_id, pdb_file, etag=None):
+        """Download a PDB file from RCSB into the cache, storing its ETag.
+        
+        With ``etag`` the request is conditional; False means 304 Not Modified.
+        """
+        url = self.pdb_url.format(protein_id)
+        headers = {"If-None-Match": etag} if etag else None
+        logger.info("Downloading %s", url)
+        response = self.session.get(
+            url, stream=True, timeout=REQUEST_TIMEOUT, headers=headers
+        )
+        with response:
+            if response.status_code == 304:
+                return False
             if response.status_code != 200:
                 raise ValueError(f"Failed to download PDB: {protein_id}")
-            with open(pdb_file, 'w') as f:
-                f.write(response.text)
-            logger.info(f"Saved PDB file to {pdb_file}")
+            # Store the compressed body verbatim; it is only inflated on read
+            response.raw.decode_content = False
+            
+            # Write to an exclusively created temp file and rename it into
+            # place, so concurrent readers never see a partial PDB file
+            fd, tmp_name = tempfile.mkstemp(
+                dir=self.cache_dir, prefix=f".{protein_id}.", suffix=".part"
+            )
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+                os.replace(tmp_name, pdb_file)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+            
+            etag_file = _etag_path(pdb_file)
+            new_etag = response.headers.get("ETag")
+            if new_etag:
+                etag_file.write_text(new_etag)
+            elif etag_file.exists():
+                etag_file.unlink()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Saved PDB file to %s", pdb_file)
+        return True
+    
+    def download_structure(self, protein_id, refresh=False):
+        """Download a PDB file into the cache if needed and return its path."""
+        protein_id = protein_id.lower()
+        pdb_file = self._pdb_path(protein_id)
+        
+        # Failed or rejected prefetches leave no file, so fetch it after all
+        pending = self._prefetching.get(protein_id)
+        if pending is not None:
+            wait([pending])
+        if not pdb_file.exists():
+            self._fetch(protein_id, pdb_file)
+        elif refresh and pending is None:
+            self.refresh_structure(protein_id)
+            pdb_file = self._pdb_path(protein_id)
         
+        return pdb_file
+    
+    def refresh_structure(self, protein_id):
+        """Re-download a cached PDB file if it changed on RCSB; True if it did."""
+        protein_id = protein_id.lower()
+        pdb_file = self._pdb_path(protein_id)
+        gz_file = self.cache_dir / f"{protein_id}.pdb.gz"
+        etag_file = _etag_path(gz_file)
+        etag = etag_file.read_text() if gz_file.exists() and etag_file.exists() else None
+        
+        if not self._fetch(protein_id, gz_file, etag=etag):
+            return False
+        if pdb_file != gz_file:
+            pdb_file.unlink()  # Superseded uncompressed copy
+        self._structure_cache.discard(protein_id)
+        return True
+    
+    def refresh_all(self):
+        """Revalidate every cached PDB file, mapping IDs to results or exceptions."""
+        protein_ids = sorted({
+            path.name.split(".")[0]
+            for pattern in ("*.pdb", "*.pdb.gz")
+            for path in self.cache_dir.glob(pattern)
+        })
+        
+        def refresh(protein_id):
+            try:
+                return self.refresh_structure(protein_id)
+            except Exception as e:
+                logger.warning("Failed to refresh %s: %s", protein_id, e)
+                return e
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(protein_ids, executor.map(refresh, protein_ids)))
+    
+    def prefetch(self, protein_ids, depth=16, max_resolution=None, min_length=None):
+        """Start downloading up to ``depth`` PDB files in the background.
+        
+        Files of entries whose summary fails the given criteria are skipped.
+        """
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="pdb-prefetch"
+                )
+            
+            # Done futures may not have been popped by _prefetch_done yet
+            in_flight = sum(not future.done() for future in self._prefetching.values())
+            for protein_id in protein_ids:
+                if in_flight >= depth:
+                    break
+                protein_id = protein_id.lower()
+                pdb_file = self._pdb_path(protein_id)
+                if protein_id in self._prefetching or pdb_file.exists():
+                    continue
+                future = self._prefetch_executor.submit(
+                    self._prefetch_one, protein_id, pdb_file, max_resolution, min_length
+                )
+                self._prefetching[protein_id] = future
+                in_flight += 1
+                future.add_done_callback(functools.partial(self._prefetch_done, protein_id))
+    
+    def _prefetch_one(self, protein_id, pdb_file, max_resolution, min_length):
+        """Background job of prefetch: download a file unless summary rules it out."""
+        if self._entry_summary_reject(protein_id, max_resolution, min_length) is None:
+            self._fetch(protein_id, pdb_file)
+    
+    def wait_for_prefetch(self, protein_id):
+        """Block until a pending prefetch of ``protein_id``, if any, has finished."""
+        pending = self._prefetching.get(protein_id.lower())
+        if pending is not None:
+            wait([pending])
+    
+    def _prefetch_done(self, protein_id, future):
+        """Forget a finished prefetch; failures are retried on next access."""
+        with self._prefetch_lock:
+            self._prefetching.pop(protein_id, None)
+        if future.exception() is not None:
+            logger.warning("Prefetch of %s failed: %s", protein_id, future.exception())
+    
+    def download_structures(self, protein_ids):
+        """Download many PDB files concurrently.
+        
+        Returns a dict mapping each protein ID to its cached file path or, if
+        the download failed, to the exception that was raised.
+        """
+        protein_ids = list(dict.fromkeys(pid.lower() for pid in protein_ids))
+        
+        def fetch(protein_id):
+            try:
+                return self.download_structure(protein_id)
+            except Exception as e:
+                logger.warning("Failed to download %s: %s", protein_id, e)
+                return e
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(protein_ids, executor.map(fetch, protein_ids)))
+    
+    def _parse_structure(self, protein_id):
+        """Download (if needed) and parse a structure, bypassing the cache."""
+        pdb_file = self.download_structure(protein_id)
+        with _open_pdb(pdb_file) as f, self._parse_lock:
+            return self.parser.get_structure(protein_id, f)
+    
+    def get_structure(self, protein_id, parser="biopython", refresh=False):
+        """Retrieve structure for a protein from PDB, optionally revalidating it."""
         # For now, only support BioPython parser
-        return self.parser.get_structure(protein_id, str(pdb_file))
+        protein_id = protein_id.lower()
+        if refresh:
+            self.download_structure(protein_id, refresh=True)
+        structure = self._structure_cache.get(protein_id)
+        if structure is None:
+            structure = self._parse_structure(protein_id)
+            self._structure_cache.put(protein_id, structure)
+        return structure
     
-    def get_function(self, protein_id):
-        """Retrieve functional annotation for a protein from PDB."""
-        structure = self.get_structure(protein_id)
-        header = structure.header
+    def prefetch_into_cache(self, protein_ids):
+        """Parse structures into the in-memory cache on a background thread.
         
+        Structures that are already cached are skipped, and nothing is done
+        when the structure cache is disabled.
+        """
+        if not self.structure_cache_bytes:
+            return
+        with self._prefetch_lock:
+            if self._parse_executor is None:
+                self._parse_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="pdb-parse"
+                )
+        for protein_id in protein_ids:
+            protein_id = protein_id.lower()
+            if protein_id not in self._structure_cache:
+                self._parse_executor.submit(self._warm_structure, protein_id)
+    
+    def _warm_structure(self, protein_id):
+        """Background job of prefetch_into_cache."""
+        try:
+            self.get_structure(protein_id)
+        except Exception as e:
+            logger.warning("Could not prefetch structure of %s: %s", protein_id, e)
+    
+    def clear_cache(self):
+        """Drop all parsed structures and entry summaries held in memory."""
+        self._structure_cache.clear()
+        self._load_entry_summary.cache_clear()
+    
+    def get_structures_bulk(self, protein_ids):
+        """Retrieve structures for many proteins, downloading them concurrently.
+        
+        Parsing only starts once every file is on disk. Proteins that could not
+        be downloaded are left out of the result.
+        """
+        pdb_files = self.download_structures(protein_ids)
         return {
-            "id": protein_id,
-            "description": header.get("name", ""),
-            "resolution": header.get("resolution", None),
-            "structure_method": header.get("structure_method", ""),
-            "keywords": header.get("keywords", []),
-            "ec_numbers": []
+            protein_id: self.get_structure(protein_id)
+            for protein_id, pdb_file in pdb_files.items()
+            if not isinstance(pdb_file, Exception)
         }
     
+    def _fetch_entry_summary(self, protein_id):
+        """Download the RCSB entry summary, bypassing the cache."""
+        url = self.entry_url.format(protein_id)
+        response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to download entry summary: {protein_id}")
+        return response.json()
+    
+    def get_entry_summary(self, protein_id):
+        """Retrieve the lightweight RCSB entry summary (a few KB of JSON)."""
+        return self._load_entry_summary(protein_id.lower())
+    
+    def rejected_by_summary(self, protein_id, max_resolution=None, min_length=None):
+        """Return why the entry summary rules out an uncached protein, or None."""
+        if self._pdb_path(protein_id.lower()).exists():
+            return None
+        return self._entry_summary_reject(protein_id, max_resolution, min_length)
+    
+    def _entry_summary_reject(self, protein_id, max_resolution=None, min_length=None):
+        """Return why the entry summary rules a protein out, or None.
+        
+        Multi-model entries skip the length check; their file count spans all models.
+        """
+        if max_resolution is None and min_length is None:
+            return None
+        try:
+            entry_info = self.get_entry_summary(protein_id).get("rcsb_entry_info") or {}
+        except Exception as e:
+            logger.debug("No entry summary for %s: %s", protein_id, e)
+            return None
+        
+        resolution = (entry_info.get("resolution_combined") or [None])[0]
+        if max_resolution is not None and resolution is not None and resolution > max_resolution:
+            return f"Resolution {resolution} > {max_resolution}"
+        monomer_count = entry_info.get("deposited_polymer_monomer_count")
+        single_model = (entry_info.get("deposited_model_count") or 1) == 1
+        if (min_length is not None and monomer_count is not None and single_model
+                and monomer_count < min_length):
+            return f"Too short: {monomer_count} < {min_length}"
+        return None
+    
+    def get_header(self, protein_id):
+        """Read the header of a PDB entry without parsing its coordinates."""
+        pdb_file = self.download_structure(protein_id)
+        with _open_pdb(pdb_file) as f:
+            return PDB.parse_pdb_header(f)
+    
+    def get_function(self, protein_id, structure=None):
+        """Retrieve functional annotation for a protein from PDB.
+        
+        Uncached entries are annotated from their summary, without a download.
+        """
+        pdb_id = protein_id.lower()
+        if structure is not None:
+            header = structure.header
+        else:
+            # A rejected prefetch leaves no file behind
+            self.wait_for_prefetch(pdb_id)
+            if self._pdb_path(pdb_id).exists():
+                header = self.get_header(protein_id)
+            else:
+                try:
+                    header = _header_from_summary(self.get_entry_summary(protein_id))
+                except Exception:
+                    header = self.get_header(protein_id)
+        return _function_from_header(protein_id, header)
+    
     def validate_structure(self, protein_id, max_resolution=2.5, min_length=50, max_length=300):
         """Validate if a protein structure meets criteria."""
+        is_valid, validation_info, _ = self.evaluate_structure(
+            protein_id, max_resolution, min_length, max_length
+        )
+        return is_valid, validation_info
+    
+    def evaluate_structure(self, protein_id, max_resolution=2.5, min_length=50, max_length=300):
+        """Return ``(is_valid, validation_info, function_info)`` from one header read.
+        
+        ``function_info`` is None if the protein could not be loaded at all.
+        """
         try:
-            structure = self.get_structure(protein_id)
-            function_info = self.get_function(protein_id)
+            self.wait_for_prefetch(protein_id)
+            pdb_file = self._pdb_path(protein_id.lower())
+            
+            # Reject from the entry summary before downloading the full file
+            if not pdb_file.exists():
+                reason = self._entry_summary_reject(protein_id, max_resolution, min_length)
+                if reason is not None:
+                    return False, {"reason": reason}, self.get_function(protein_id)
+                pdb_file = self.download_structure(protein_id)
+            
+            with _open_pdb(pdb_file) as f:
+                function_info = _function_from_header(protein_id, PDB.parse_pdb_header(f))
             
             # Check resolution
             resolution = function_info.get("resolution")
             if resolution is None or resolution > max_resolution:
-                return False, {"reason": f"Resolution {resolution} > {max_resolution}"}
+                return False, {"reason": f"Resolution {resolution} > {max_resolution}"}, function_info
             
-            # Count amino acids
-            amino_acid_count = 0
-            for model in structure:
-                for chain in model:
-                    for residue in chain:
-                        if residue.id[0] == ' ':  # Standard amino acid
-                            amino_acid_count += 1
+            # Count amino acids straight from the file's CA records; building
+            # the full BioPython object graph is not needed for a count
+            amino_acid_count = _count_standard_residues(pdb_file)
             
             # Check length criteria
             if amino_acid_count < min_length:
-                return False, {"reason": f"Too short: {amino_acid_count} < {min_length}"}
+                return False, {"reason": f"Too short: {amino_acid_count} < {min_length}"}, function_info
             if amino_acid_count > max_length:
-                return False, {"reason": f"Too long: {amino_acid_count} > {max_length}"}
+                return False, {"reason": f"Too long: {amino_acid_count} > {max_length}"}, function_info
             
             validation_info = {
                 "resolution": resolution,
@@ -99,10 +560,10 @@ class PDBDataSource(ProteinDataSource):
                 "has_ec_number": False
             }
             
-            return True, validation_info
+            return True, validation_info, function_info
             
         except Exception as e:
-            return False, {"reason": f"Error: {str(e)}"}
+            return False, {"reason": f"Error: {str(e)}"}, None
 
 def get_data_source(source_type="pdb", **kwargs):
     """Factory function to get an instance of a data source."""
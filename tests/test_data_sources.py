@@ -0,0 +1,562 @@
+"""
+Tests for the protein data sources and the dataset registry.
+
+All tests run offline: PDB files are small synthetic fixtures and HTTP
+requests go to a fake session.
+"""
+
+from concurrent.futures import Future
+import gzip
+import io
+import json
+import pickle
+import threading
+
+import pytest
+
+from src.data.dataset import REGISTRY_COLUMNS, Evaluation, ProteinDatasetRegistry
+from src.data.sources import (
+    PDBDataSource,
+    ProteinDataSource,
+    _StructureCache,
+    _count_standard_residues,
+    _estimate_structure_size,
+)
+
+
+def atom(serial, name, resname, resseq, altloc=" ", record="ATOM  ", chain="A"):
+    """Format a single fixed-width PDB coordinate record."""
+    return (
+        f"{record}{serial:5d} {name:<4}{altloc}{resname:>3} {chain}{resseq:4d}    "
+        f"{float(resseq):8.3f}{0.0:8.3f}{0.0:8.3f}{1.0:6.2f}{10.0:6.2f}"
+        f"          {name.strip()[0]:>2}"
+    )
+
+
+def pdb_text(residues=60, resolution=2.0, extra_records=()):
+    """Return a minimal PDB file with ``residues`` alanines carrying a CA atom."""
+    lines = [
+        "HEADER    HYDROLASE                               01-JAN-00   1ABC",
+        "TITLE     TEST PROTEIN",
+        f"REMARK   2 RESOLUTION.    {resolution:.2f} ANGSTROMS.",
+    ]
+    serial = 1
+    for resseq in range(1, residues + 1):
+        for name in (" N", " CA", " C"):
+            lines.append(atom(serial, name, "ALA", resseq))
+            serial += 1
+    lines.extend(extra_records)
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def write_pdb(path, text):
+    """Write PDB text to ``path``, gzip-compressed if the name ends in .gz."""
+    data = text.encode()
+    path.write_bytes(gzip.compress(data) if path.suffix == ".gz" else data)
+    return path
+
+
+class FakeResponse:
+    """Just enough of requests.Response for PDBDataSource."""
+    
+    def __init__(self, status_code=200, body=b"", headers=None, json_data=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = io.BytesIO(body)
+        self._json_data = json_data
+    
+    def json(self):
+        return self._json_data
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """Serves gzipped PDB files and entry summaries; records every request."""
+    
+    def __init__(self, pdb_files=None, summaries=None):
+        self.pdb_files = pdb_files or {}
+        self.summaries = summaries or {}
+        self.etags = {}
+        self.requests = []
+        # Cleared to hold every response back, e.g. to keep a prefetch in flight
+        self.gate = threading.Event()
+        self.gate.set()
+    
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append((url, headers))
+        self.gate.wait()
+        protein_id = url.rsplit("/", 1)[1].split(".")[0].lower()
+        if "/core/entry/" in url:
+            if protein_id not in self.summaries:
+                return FakeResponse(404)
+            return FakeResponse(json_data=self.summaries[protein_id])
+        if protein_id not in self.pdb_files:
+            return FakeResponse(404)
+        etag = self.etags.get(protein_id)
+        if etag and (headers or {}).get("If-None-Match") == etag:
+            return FakeResponse(304)
+        return FakeResponse(
+            body=gzip.compress(self.pdb_files[protein_id].encode()),
+            headers={"ETag": etag} if etag else {},
+        )
+    
+    def urls(self, kind):
+        """Requested URLs of one kind, ``"download"`` or ``"entry"``."""
+        return [url for url, _ in self.requests if f"/{kind}/" in url]
+
+
+def entry_summary(resolution=2.0, monomer_count=60):
+    """Return a minimal RCSB entry summary."""
+    return {
+        "rcsb_entry_info": {
+            "resolution_combined": [resolution],
+            "deposited_polymer_monomer_count": monomer_count,
+        },
+        "struct": {"title": "TEST PROTEIN"},
+        "exptl": [{"method": "X-RAY DIFFRACTION"}],
+        "struct_keywords": {"text": "HYDROLASE"},
+    }
+
+
+def fake_source(tmp_path, **session_kwargs):
+    """A PDBDataSource whose requests go to a FakeSession."""
+    source = PDBDataSource(cache_dir=tmp_path / "raw")
+    source.session = FakeSession(**session_kwargs)
+    return source
+
+
+def test_count_standard_residues_counts_ca_bearing_amino_acids(tmp_path):
+    extra_records = [
+        # Alternate locations of one CA count once
+        atom(900, " N", "GLY", 61),
+        atom(901, " CA", "GLY", 61, altloc="A"),
+        atom(902, " CA", "GLY", 61, altloc="B"),
+        # A residue without a modelled CA atom is not counted
+        atom(903, " N", "SER", 62),
+        atom(904, " C", "SER", 62),
+        # Nucleotides and hetero groups are not counted either
+        atom(905, " P", "DA", 1, chain="B"),
+        atom(906, " C1'", "DA", 1, chain="B"),
+        atom(907, " P", "DT", 2, chain="B"),
+        atom(908, " O", "HOH", 100, record="HETATM"),
+    ]
+    pdb_file = write_pdb(tmp_path / "1abc.pdb.gz", pdb_text(3, extra_records=extra_records))
+    
+    assert _count_standard_residues(pdb_file) == 4
+
+
+def test_count_standard_residues_counts_ca_on_first_line(tmp_path):
+    lines = [atom(1, " CA", "ALA", 1), atom(2, " CA", "ALA", 2), "END"]
+    pdb_file = write_pdb(tmp_path / "1abc.pdb", "\n".join(lines) + "\n")
+    
+    assert _count_standard_residues(pdb_file) == 2
+
+
+def test_validate_structure_uses_ca_count(tmp_path):
+    write_pdb(tmp_path / "1abc.pdb.gz", pdb_text(60))
+    source = PDBDataSource(cache_dir=tmp_path)
+    
+    assert source.validate_structure("1ABC", min_length=50) == (
+        True, {"resolution": 2.0, "amino_acid_count": 60, "has_ec_number": False}
+    )
+    assert source.validate_structure("1ABC", min_length=61) == (
+        False, {"reason": "Too short: 60 < 61"}
+    )
+
+
+@pytest.fixture
+def registry(tmp_path):
+    """A registry over a cache holding three valid synthetic PDB files."""
+    source = PDBDataSource(cache_dir=tmp_path / "raw")
+    for protein_id in ("1abc", "2abc", "3abc"):
+        write_pdb(source.cache_dir / f"{protein_id}.pdb.gz", pdb_text(60))
+    with ProteinDatasetRegistry(source, tmp_path / "protein_registry.json") as registry:
+        yield registry
+
+
+def reopen(registry):
+    """Load a second registry from the files written by ``registry``."""
+    return ProteinDatasetRegistry(registry.data_source, registry.registry_file)
+
+
+@pytest.fixture
+def mixed_registry(tmp_path):
+    """A registry holding a valid, a failed and an undated evaluation."""
+    registry = ProteinDatasetRegistry(StaticSource(), tmp_path / "protein_registry.json")
+    registry.proteins = {
+        "1abc": Evaluation(
+            "1abc", True,
+            validation_info={"resolution": 2.0, "amino_acid_count": 60},
+            function_info={"resolution": 2.0, "ec_numbers": ["3.2.1.17"]},
+            evaluation_date="2024-01-01T12:00:00+02:00",
+        ),
+        # Written before timestamps carried a UTC offset
+        "2abc": Evaluation("2abc", False, error="boom", evaluation_date="2024-01-01T12:00:00.5"),
+        "3abc": Evaluation(
+            "3abc", False,
+            validation_info={"reason": "Resolution 3.1 > 2.5"},
+            function_info={"resolution": 3.1, "ec_numbers": []},
+        ),
+    }
+    return registry
+
+
+def test_to_dataframe_types_columns_and_normalises_dates(mixed_registry):
+    df = mixed_registry.to_dataframe()
+    
+    assert {name: str(dtype) for name, dtype in df.dtypes.items()} == REGISTRY_COLUMNS
+    assert list(df["protein_id"]) == ["1abc", "2abc", "3abc"]
+    assert df["resolution"].isna().tolist() == [False, True, False]
+    assert (df["resolution"][0], df["resolution"][2]) == (2.0, pytest.approx(3.1))
+    assert df["aa_count"].isna().tolist() == [False, True, True] and df["aa_count"][0] == 60
+    assert [str(date) for date in df["evaluation_date"][:2]] == [
+        "2024-01-01 10:00:00+00:00", "2024-01-01 12:00:00.500000+00:00"
+    ]
+    assert df["evaluation_date"].isna().tolist() == [False, False, True]
+    assert df["ec_numbers"].tolist() == [["3.2.1.17"], [], []]
+
+
+def test_save_parquet_round_trips_registry_columns(mixed_registry):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    
+    path = mixed_registry.save_parquet()
+    assert path == mixed_registry.registry_file.with_suffix(".parquet")
+    
+    df = pd.read_parquet(path)
+    expected = mixed_registry.to_dataframe()
+    assert {name: str(dtype) for name, dtype in df.dtypes.items()} == REGISTRY_COLUMNS
+    assert df.drop(columns="ec_numbers").equals(expected.drop(columns="ec_numbers"))
+    assert [list(ec_numbers) for ec_numbers in df["ec_numbers"]] == [["3.2.1.17"], [], []]
+
+
+def test_registry_log_is_opened_lazily(registry):
+    assert not registry.log_file.exists()
+    registry.add_protein("1ABC")
+    assert registry.log_file.exists()
+
+
+def test_registry_replays_log_over_snapshot(registry):
+    registry.add_protein("1abc")
+    registry.save_registry(compact=True)
+    registry.add_protein("2abc")
+    registry.save_registry()
+    
+    assert len(registry.log_file.read_bytes().splitlines()) == 1
+    assert set(reopen(registry).proteins) == {"1abc", "2abc"}
+    assert reopen(registry).proteins["2abc"] == registry.proteins["2abc"]
+
+
+def test_registry_skips_torn_log_line(registry):
+    registry.add_protein("1abc")
+    registry.close()
+    with open(registry.log_file, 'ab') as f:
+        f.write(b'{"protein_id":"2abc","meets_crit')
+    
+    assert set(reopen(registry).proteins) == {"1abc"}
+
+
+def test_registry_compact_folds_log_into_snapshot(registry):
+    registry.add_protein(["1abc", "2abc"])
+    registry.save_registry(compact=True)
+    
+    assert registry.log_file.read_bytes() == b""
+    snapshot = reopen(registry)
+    assert snapshot.proteins == registry.proteins
+    assert snapshot.registry_file.read_text().startswith("{\n  ")
+
+
+def test_registry_save_compacts_once_log_outgrows_snapshot(registry):
+    registry.add_protein("1abc")
+    registry.save_registry(compact=True)
+    
+    registry.add_protein("2abc")
+    registry.save_registry()
+    assert len(registry.log_file.read_bytes().splitlines()) == 1
+    
+    registry.add_protein("3abc")
+    registry.save_registry()
+    assert not registry.log_file.read_bytes()
+    assert set(reopen(registry).proteins) == {"1abc", "2abc", "3abc"}
+
+
+def test_pdb_data_source_pickles_to_its_configuration(tmp_path):
+    source = PDBDataSource(cache_dir=tmp_path, max_workers=4, structure_cache_bytes=1 << 20)
+    copy = pickle.loads(pickle.dumps(source))
+    
+    assert (copy.cache_dir, copy.max_workers, copy.structure_cache_bytes) == (
+        tmp_path, 4, 1 << 20
+    )
+
+
+class StaticSource(ProteinDataSource):
+    """A data source without prefetch support that accepts every protein."""
+    
+    def get_structure(self, protein_id):
+        return None
+    
+    def get_function(self, protein_id):
+        return {"id": protein_id, "ec_numbers": []}
+    
+    def validate_structure(self, protein_id, max_resolution, min_length, max_length):
+        return True, {"amino_acid_count": min_length}
+
+
+def test_add_proteins_in_process_with_any_data_source(tmp_path):
+    with ProteinDatasetRegistry(StaticSource(), tmp_path / "protein_registry.json") as registry:
+        evaluations = registry.add_proteins(["1ABC", "2abc"], workers=1)
+    
+    assert [evaluation.protein_id for evaluation in evaluations] == ["1abc", "2abc"]
+    assert all(evaluation.meets_criteria for evaluation in evaluations)
+
+
+def test_prefetch_window_ignores_finished_prefetches(tmp_path):
+    source = fake_source(tmp_path, pdb_files={"1abc": pdb_text(60)})
+    # A finished download whose done callback has not forgotten it yet
+    finished = Future()
+    finished.set_result(None)
+    source._prefetching["9xyz"] = finished
+    
+    source.prefetch(["1abc"], depth=1)
+    source.wait_for_prefetch("1abc")
+    
+    assert source.session.urls("download") == [source.pdb_url.format("1abc")]
+    assert (source.cache_dir / "1abc.pdb.gz").exists()
+
+
+def test_valid_proteins_and_summary_agree(registry):
+    registry.min_length = 61
+    registry.add_protein("1abc")
+    registry.min_length = 50
+    registry.add_protein(["2abc", "3abc"])
+    
+    assert list(registry.get_valid_proteins()) == ["2abc", "3abc"]
+    assert list(registry.get_valid_proteins(as_dataframe=True)["protein_id"]) == ["2abc", "3abc"]
+    summary = registry.generate_summary_report()
+    assert (summary["total_proteins_evaluated"], summary["valid_proteins"]) == (3, 2)
+
+
+@pytest.fixture
+def summary_source(tmp_path):
+    """A fake RCSB serving one entry that passes and two the summary rejects."""
+    return fake_source(
+        tmp_path,
+        pdb_files={pid: pdb_text(60) for pid in ("1low", "1sho", "1ok")},
+        summaries={
+            "1low": entry_summary(resolution=3.1),
+            "1sho": entry_summary(monomer_count=20),
+            "1ok": entry_summary(),
+        },
+    )
+
+
+def test_validate_structure_rejects_from_summary_without_download(summary_source):
+    assert summary_source.validate_structure("1LOW") == (
+        False, {"reason": "Resolution 3.1 > 2.5"}
+    )
+    assert summary_source.validate_structure("1sho") == (
+        False, {"reason": "Too short: 20 < 50"}
+    )
+    assert summary_source.session.urls("download") == []
+
+
+def test_structure_is_downloaded_after_rejected_prefetch(summary_source):
+    summary_source.session.gate.clear()
+    summary_source.prefetch(["1low"], max_resolution=2.5)
+    threading.Timer(0.1, summary_source.session.gate.set).start()
+    
+    # Asked while the prefetch is still in flight
+    assert summary_source.get_function("1low")["description"] == "test protein"
+    assert summary_source.session.urls("download") == []
+    assert len(summary_source.get_structure("1low")[0]["A"]) == 60
+
+
+def test_add_protein_list_skips_downloads_rejected_by_summary(summary_source, tmp_path):
+    with ProteinDatasetRegistry(summary_source, tmp_path / "protein_registry.json") as registry:
+        evaluations = registry.add_protein(["1low", "1sho", "1ok"])
+    
+    assert [evaluation.meets_criteria for evaluation in evaluations] == [False, False, True]
+    assert evaluations[0]["validation_info"] == {"reason": "Resolution 3.1 > 2.5"}
+    assert summary_source.session.urls("download") == [summary_source.pdb_url.format("1ok")]
+    assert len(summary_source.session.urls("entry")) == 3
+
+
+def test_add_proteins_evaluates_summary_rejects_without_workers(summary_source, tmp_path):
+    # The worker has no fake session, so give it a cached file to read
+    summary_source.download_structure("1ok")
+    with ProteinDatasetRegistry(summary_source, tmp_path / "protein_registry.json") as registry:
+        evaluations = registry.add_proteins(["1low", "1sho", "1ok"], workers=2)
+    
+    assert [evaluation.meets_criteria for evaluation in evaluations] == [False, False, True]
+    assert evaluations[1]["validation_info"] == {"reason": "Too short: 20 < 50"}
+    assert len(summary_source.session.urls("entry")) == 2
+
+
+def test_selection_criteria_cannot_be_changed_silently(registry):
+    with pytest.raises(TypeError):
+        registry.selection_criteria["max_resolution"] = 3.0
+    with pytest.raises(ValueError):
+        registry.selection_criteria = {"max_resolutoin": 3.0}
+    
+    registry.selection_criteria = {"max_resolution": 3.0}
+    assert registry.max_resolution == 3.0
+    assert registry.generate_summary_report()["selection_criteria"]["max_resolution"] == 3.0
+
+
+@pytest.fixture
+def structures(tmp_path):
+    """Three parsed 10-residue structures of equal estimated size."""
+    source = PDBDataSource(cache_dir=tmp_path / "raw", structure_cache_bytes=0)
+    for protein_id in ("1abc", "2abc", "3abc"):
+        write_pdb(source.cache_dir / f"{protein_id}.pdb.gz", pdb_text(10))
+    return {pid: source.get_structure(pid) for pid in ("1abc", "2abc", "3abc")}
+
+
+def test_structure_cache_evicts_least_recently_used(structures):
+    size = _estimate_structure_size(structures["1abc"])
+    cache = _StructureCache(int(2.5 * size))
+    cache.put("1abc", structures["1abc"])
+    cache.put("2abc", structures["2abc"])
+    assert cache.get("1abc") is structures["1abc"]
+    
+    cache.put("3abc", structures["3abc"])
+    assert "2abc" not in cache
+    assert cache.get("1abc") is structures["1abc"]
+    assert cache.get("3abc") is structures["3abc"]
+    assert cache.current_bytes == 2 * size
+
+
+def test_structure_cache_accounts_for_discard_and_clear(structures):
+    size = _estimate_structure_size(structures["1abc"])
+    cache = _StructureCache(3 * size)
+    for protein_id, structure in structures.items():
+        cache.put(protein_id, structure)
+    cache.put("1abc", structures["1abc"])
+    assert cache.current_bytes == 3 * size
+    
+    cache.discard("2abc")
+    assert "2abc" not in cache and cache.current_bytes == 2 * size
+    cache.clear()
+    assert cache.get("1abc") is None and cache.current_bytes == 0
+
+
+def test_structure_cache_skips_structures_larger_than_bound(structures):
+    cache = _StructureCache(_estimate_structure_size(structures["1abc"]) - 1)
+    cache.put("1abc", structures["1abc"])
+    
+    assert "1abc" not in cache and cache.current_bytes == 0
+
+
+def test_get_structure_reuses_parsed_structure(registry):
+    source = registry.data_source
+    structure = source.get_structure("1ABC")
+    assert source.get_structure("1abc") is structure
+    
+    source.clear_cache()
+    assert source.get_structure("1abc") is not structure
+
+
+def test_evaluation_supports_dict_style_reads():
+    evaluation = Evaluation("1abc", False, error="boom", evaluation_date="2024-01-01")
+    
+    assert evaluation["error"] == "boom"
+    assert "error" in evaluation and "validation_info" not in evaluation
+    assert evaluation.get("validation_info", {}) == {}
+    assert evaluation.to_dict() == {
+        "protein_id": "1abc",
+        "meets_criteria": False,
+        "error": "boom",
+        "evaluation_date": "2024-01-01",
+    }
+    with pytest.raises(KeyError):
+        evaluation["missing"]
+    with pytest.raises(KeyError):
+        evaluation["validation_info"]
+
+
+@pytest.fixture
+def etag_source(tmp_path):
+    """A fake RCSB serving one entry with an ETag."""
+    source = fake_source(tmp_path, pdb_files={"1abc": pdb_text(60)})
+    source.session.etags["1abc"] = '"v1"'
+    return source
+
+
+def test_download_stores_etag(etag_source):
+    pdb_file = etag_source.download_structure("1abc")
+    
+    assert pdb_file.name == "1abc.pdb.gz"
+    assert (etag_source.cache_dir / "1abc.pdb.gz.etag").read_text() == '"v1"'
+    assert etag_source.session.requests[-1][1] is None
+
+
+def test_refresh_unchanged_file_is_not_modified(etag_source):
+    structure = etag_source.get_structure("1abc")
+    before = (etag_source.cache_dir / "1abc.pdb.gz").read_bytes()
+    
+    assert etag_source.refresh_structure("1abc") is False
+    assert etag_source.session.requests[-1][1] == {"If-None-Match": '"v1"'}
+    assert (etag_source.cache_dir / "1abc.pdb.gz").read_bytes() == before
+    assert etag_source.get_structure("1abc", refresh=True) is structure
+
+
+def test_refresh_changed_file_is_rewritten_and_reparsed(etag_source):
+    structure = etag_source.get_structure("1abc")
+    etag_source.session.pdb_files["1abc"] = pdb_text(70)
+    etag_source.session.etags["1abc"] = '"v2"'
+    
+    refreshed = etag_source.get_structure("1abc", refresh=True)
+    assert refreshed is not structure
+    assert len(refreshed[0]["A"]) == 70
+    assert (etag_source.cache_dir / "1abc.pdb.gz.etag").read_text() == '"v2"'
+
+
+def test_refresh_replaces_legacy_uncompressed_file(tmp_path):
+    source = fake_source(tmp_path, pdb_files={"1abc": pdb_text(70)})
+    write_pdb(source.cache_dir / "1abc.pdb", pdb_text(60))
+    assert source.download_structure("1abc").name == "1abc.pdb"
+    
+    assert source.refresh_structure("1abc") is True
+    assert not (source.cache_dir / "1abc.pdb").exists()
+    assert _count_standard_residues(source.download_structure("1abc")) == 70
+
+
+def test_refresh_all_reports_each_cached_file(etag_source):
+    etag_source.download_structure("1abc")
+    write_pdb(etag_source.cache_dir / "2abc.pdb.gz", pdb_text(60))
+    
+    results = etag_source.refresh_all()
+    assert results["1abc"] is False
+    assert isinstance(results["2abc"], ValueError)
+
+
+def test_registry_close_folds_log_into_snapshot(registry):
+    registry.add_protein("1abc")
+    registry.save_registry()
+    registry.add_protein("2abc")
+    registry.close()
+    
+    assert registry.log_file.read_bytes() == b""
+    assert set(json.loads(registry.registry_file.read_text())) == {"1abc", "2abc"}
+
+
+def test_summary_length_check_skips_multi_model_entries(tmp_path):
+    summary = entry_summary(monomer_count=30)
+    summary["rcsb_entry_info"]["deposited_model_count"] = 2
+    # Two models of 30 residues each hold 60 CA records in the file
+    lines = pdb_text(0).splitlines()[:-1]
+    for model in (1, 2):
+        lines.append(f"MODEL     {model:4d}")
+        lines.extend(atom(resseq, " CA", "ALA", resseq) for resseq in range(1, 31))
+        lines.append("ENDMDL")
+    models = "\n".join(lines + ["END"]) + "\n"
+    source = fake_source(tmp_path, pdb_files={"1nmr": models}, summaries={"1nmr": summary})
+    
+    assert source.rejected_by_summary("1nmr", min_length=50) is None
+    assert source.validate_structure("1nmr")[1]["amino_acid_count"] == 60